@@ -1,4 +1,7 @@
+import numpy as np
+
 from dataclasses import dataclass
+from typing import Tuple
 from echemsuite.cyclicvoltammetry.read_input import CyclicVoltammetry
 
 
@@ -9,6 +12,10 @@ class CVExperiment:
     vref: float
     filename: str
 
+    @property
+    def cycles(self) -> list:
+        return [df for df in self.data if type(df["Vf"]) != np.float64]
+
 
 @dataclass
 class Trace:
@@ -30,4 +37,33 @@ class PlotSettings:
     vmin: float = -2.0
     vmax: float = 2.0
     imin: float = -1.0
-    imax: float = 1.0
\ No newline at end of file
+    imax: float = 1.0
+
+
+def apply_plot_settings(
+    voltage, current, experiment: CVExperiment, settings: PlotSettings
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Apply the potential shift and the area normalization selected in a `PlotSettings`
+    object to the raw voltage and current of a cycle.
+    """
+    x = np.asarray(voltage, dtype=float)
+    y = np.asarray(current, dtype=float)
+
+    if settings.shift_with_vref:
+        x = x + experiment.vref
+
+    if settings.normalize_by_area:
+        y = y / experiment.area
+
+    return x, y
+
+
+@dataclass
+class EnsembleTrace:
+    name: str
+    members: list
+    color: str
+    linestyle: str
+    band: str = "std"
+    npoints: int = 500
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import warnings
+import numpy as np
+
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from core.data_structures import (
+    CVExperiment,
+    EnsembleTrace,
+    PlotSettings,
+    apply_plot_settings,
+)
+
+
+@dataclass
+class BranchStatistics:
+    mean: np.ndarray
+    std: np.ndarray
+    min: np.ndarray
+    max: np.ndarray
+    count: np.ndarray
+
+
+@dataclass
+class EnsembleResult:
+    grid: np.ndarray
+    forward: BranchStatistics
+    reverse: BranchStatistics
+
+
+def split_branches(
+    voltage: np.ndarray, current: np.ndarray
+) -> Tuple[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+    """
+    Split a cycle in its forward (increasing potential) and reverse (decreasing
+    potential) branches. The cycle is cut at the vertices, located by the maximum and
+    minimum potential, so that the noise on the single potential steps does not move
+    points between the branches. Each branch is returned sorted by increasing potential.
+    """
+    if len(voltage) < 2:
+        empty = (np.empty(0), np.empty(0))
+        return empty, empty
+
+    imax, imin = int(np.argmax(voltage)), int(np.argmin(voltage))
+    index = np.arange(len(voltage))
+
+    # The outer segments (start to first vertex, second vertex to end) share the same
+    # direction, opposite to the one of the inner segment. Vertices belong to both.
+    outer = (index <= min(imax, imin)) | (index >= max(imax, imin))
+    inner = ~outer
+    inner[[imax, imin]] = True
+
+    if imax < imin:
+        forward, reverse = outer, inner
+    else:
+        forward, reverse = inner, outer
+
+    branches = []
+    for mask in (forward, reverse):
+        x, y = voltage[mask], current[mask]
+        order = np.argsort(x, kind="stable")
+        branches.append((x[order], y[order]))
+
+    return branches[0], branches[1]
+
+
+def resample_branches(
+    branches: List[Tuple[np.ndarray, np.ndarray]], grid: np.ndarray
+) -> np.ndarray:
+    """
+    Interpolate all the `branches` on the potential `grid` with a single `np.interp`
+    call. Each branch is moved to its own non-overlapping potential window by adding
+    a row-dependent offset, so that the concatenation of all the branches is still
+    sorted. Grid points outside the potential range of a branch are set to NaN.
+    """
+    result = np.full((len(branches), len(grid)), np.nan)
+
+    rows = [i for i, (x, _) in enumerate(branches) if len(x) >= 2]
+    if rows == [] or len(grid) == 0:
+        return result
+
+    lower = min(grid[0], *[branches[i][0][0] for i in rows])
+    upper = max(grid[-1], *[branches[i][0][-1] for i in rows])
+    period = (upper - lower) + 1.0
+
+    offsets = np.arange(len(rows)) * period - lower
+    xp = np.concatenate([branches[i][0] + offset for i, offset in zip(rows, offsets)])
+    fp = np.concatenate([branches[i][1] for i in rows])
+
+    queries = grid[np.newaxis, :] + offsets[:, np.newaxis]
+    values = np.interp(queries.ravel(), xp, fp).reshape(queries.shape)
+
+    xmin = np.array([branches[i][0][0] for i in rows])
+    xmax = np.array([branches[i][0][-1] for i in rows])
+    outside = (grid < xmin[:, np.newaxis]) | (grid > xmax[:, np.newaxis])
+    values[outside] = np.nan
+
+    result[rows] = values
+    return result
+
+
+def _compute_statistics(samples: np.ndarray) -> BranchStatistics:
+    """
+    Compute the statistics of the resampled branches along the first axis. The standard
+    deviation is the sample one (`ddof=1`) and it is set to zero where a single branch
+    covers the grid point.
+    """
+    count = np.sum(~np.isnan(samples), axis=0)
+
+    # Grid points covered by less than two branches generate "empty slice" and
+    # "degrees of freedom" warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        std = np.nanstd(samples, axis=0, ddof=1)
+        return BranchStatistics(
+            np.nanmean(samples, axis=0),
+            np.where(count > 1, std, 0.0),
+            np.nanmin(samples, axis=0),
+            np.nanmax(samples, axis=0),
+            count,
+        )
+
+
+def compute_ensemble(
+    members: List[Tuple[str, int]],
+    experiments: Dict[str, CVExperiment],
+    settings: PlotSettings,
+    npoints: int,
+) -> EnsembleResult:
+    """
+    Compute the mean, standard deviation and min/max envelopes of the forward and
+    reverse branches of the selected cycles. The `members` are given as a list of
+    `(experiment name, cycle number)` tuples and the normalization and shift options of
+    `settings` are applied before resampling on a grid of `npoints` potentials spanning
+    the whole range covered by the selected cycles.
+    """
+    forward, reverse = [], []
+    for experiment_name, cycle_id in members:
+        experiment = experiments[experiment_name]
+        cycle = experiment.cycles[cycle_id]
+        voltage, current = apply_plot_settings(
+            cycle["Vf"], cycle["Im"], experiment, settings
+        )
+        fbranch, rbranch = split_branches(voltage, current)
+        forward.append(fbranch)
+        reverse.append(rbranch)
+
+    limits = [x[[0, -1]] for x, _ in forward + reverse if len(x) > 0]
+    if limits == []:
+        grid = np.empty(0)
+    else:
+        limits = np.concatenate(limits)
+        grid = np.linspace(limits.min(), limits.max(), npoints)
+
+    return EnsembleResult(
+        grid,
+        _compute_statistics(resample_branches(forward, grid)),
+        _compute_statistics(resample_branches(reverse, grid)),
+    )
+
+
+def get_ensemble_key(
+    ensemble: EnsembleTrace,
+    experiments: Dict[str, CVExperiment],
+    settings: PlotSettings,
+) -> tuple:
+    """
+    Return the cache key of `ensemble`, built from the selection of cycles, the grid
+    size and the scaling options. The style of the ensemble (name, color, line style
+    and band) is not part of the key.
+    """
+    return (
+        tuple(
+            (name, cid, experiments[name].vref, experiments[name].area)
+            for name, cid in ensemble.members
+        ),
+        ensemble.npoints,
+        settings.normalize_by_area,
+        settings.shift_with_vref,
+    )
+
+
+def get_ensemble_result(
+    ensemble: EnsembleTrace,
+    experiments: Dict[str, CVExperiment],
+    settings: PlotSettings,
+    cache: Dict[tuple, EnsembleResult],
+) -> EnsembleResult:
+    """
+    Return the `EnsembleResult` associated to `ensemble`, computing it only if it is
+    not already in `cache`.
+    """
+    key = get_ensemble_key(ensemble, experiments, settings)
+
+    if key not in cache:
+        cache[key] = compute_ensemble(
+            ensemble.members, experiments, settings, ensemble.npoints
+        )
+
+    return cache[key]
+
+
+def prune_ensemble_cache(
+    cache: Dict[tuple, EnsembleResult],
+    ensembledata: Dict[str, List[EnsembleTrace]],
+    experiments: Dict[str, CVExperiment],
+    plotsettings: Dict[str, PlotSettings],
+):
+    """
+    Remove from `cache` the results that do not belong to any of the ensembles
+    currently shown, with the current settings of their plot.
+    """
+    used_keys = set(
+        get_ensemble_key(ensemble, experiments, plotsettings[pname])
+        for pname, ensembles in ensembledata.items()
+        for ensemble in ensembles
+    )
+    for key in [key for key in cache.keys() if key not in used_keys]:
+        del cache[key]
+
+
+def get_band_coordinates(
+    result: EnsembleResult, band: str
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Return the coordinates of the mean line and of the closed band polygons of an
+    `EnsembleResult`. The forward and reverse branches are separated by a NaN so that
+    both can be drawn by a single plotly trace. The band is either the mean ± sample
+    standard deviation (`std`) or the min/max envelope (`minmax`).
+    """
+    line_x, line_y, band_x, band_y = [], [], [], []
+
+    for branch in (result.forward, result.reverse):
+        valid = branch.count > 0
+        grid, mean = result.grid[valid], branch.mean[valid]
+
+        if band == "std":
+            lower, upper = mean - branch.std[valid], mean + branch.std[valid]
+        elif band == "minmax":
+            lower, upper = branch.min[valid], branch.max[valid]
+        else:
+            raise ValueError(f"Unsupported band type `{band}`")
+
+        line_x += [grid, [np.nan]]
+        line_y += [mean, [np.nan]]
+        band_x += [grid, grid[::-1], [np.nan]]
+        band_y += [upper, lower[::-1], [np.nan]]
+
+    return (
+        np.concatenate(line_x),
+        np.concatenate(line_y),
+        np.concatenate(band_x),
+        np.concatenate(band_y),
+    )
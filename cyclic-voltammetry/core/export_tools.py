@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import os, shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from io import TextIOWrapper
+from tempfile import TemporaryDirectory
+from typing import Dict, Iterator, List
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from core.data_structures import (
+    CVExperiment,
+    EnsembleTrace,
+    Trace,
+    PlotSettings,
+    apply_plot_settings,
+)
+from core.ensemble import EnsembleResult, get_ensemble_result
+
+
+EXPORT_FORMATS = ["csv", "parquet", "hdf5"]
+
+# Archive size (in bytes) above which the user is warned before the download, since
+# the download button loads the whole archive in the memory of the server
+DOWNLOAD_WARNING_SIZE = 500 * 1024**2
+
+# Schema shared by every chunk of a Parquet export, so that it does not depend on the
+# types inferred from the first chunk (e.g. `null` columns for an empty trace)
+PARQUET_SCHEMA = pa.schema(
+    [
+        ("source", pa.string()),
+        ("trace", pa.string()),
+        ("experiment", pa.string()),
+        ("cycle", pa.int64()),
+        ("point", pa.int64()),
+        ("voltage", pa.float64()),
+        ("current", pa.float64()),
+    ]
+)
+
+
+def build_chunk(
+    source: str,
+    trace: str,
+    experiment: str,
+    cycle: int,
+    voltage: np.ndarray,
+    current: np.ndarray,
+) -> pd.DataFrame:
+    """
+    Build the long-format dataframe associated to a single trace. The dtypes are set
+    explicitly so that every chunk of an export shares the same schema.
+    """
+    npoints = len(voltage)
+    return pd.DataFrame(
+        {
+            "source": pd.Series([source] * npoints, dtype=object),
+            "trace": pd.Series([trace] * npoints, dtype=object),
+            "experiment": pd.Series([experiment] * npoints, dtype=object),
+            "cycle": np.full(npoints, cycle, dtype=np.int64),
+            "point": np.arange(npoints, dtype=np.int64),
+            "voltage": np.asarray(voltage, dtype=np.float64),
+            "current": np.asarray(current, dtype=np.float64),
+        }
+    )
+
+
+ENSEMBLE_BRANCHES = ["forward", "reverse"]
+ENSEMBLE_STATISTICS = ["mean", "std", "min", "max"]
+
+
+def iterate_plot_chunks(
+    plot_name: str,
+    traces: List[Trace],
+    ensembles: List[EnsembleTrace],
+    experiments: Dict[str, CVExperiment],
+    settings: PlotSettings,
+    cache: Dict[tuple, EnsembleResult],
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield, one trace at a time, the data shown in the plot `plot_name`. Each ensemble
+    is exported as one trace per branch and statistic, labelled as
+    `<ensemble name> / <branch> <statistic>`, with an empty `experiment` and a `cycle`
+    equal to -1. The `current` column holds the value of the statistic on the potential
+    grid points covered by at least one cycle. The resampled data are taken from
+    `cache` when available.
+    """
+    for trace in traces:
+        experiment = experiments[trace.original_experiment]
+        voltage, current = apply_plot_settings(
+            trace.voltage, trace.current, experiment, settings
+        )
+        yield build_chunk(
+            plot_name,
+            trace.name,
+            trace.original_experiment,
+            trace.original_number,
+            voltage,
+            current,
+        )
+
+    for ensemble in ensembles:
+        result = get_ensemble_result(ensemble, experiments, settings, cache)
+        for bname, branch in zip(ENSEMBLE_BRANCHES, [result.forward, result.reverse]):
+            valid = branch.count > 0
+            for statistic in ENSEMBLE_STATISTICS:
+                yield build_chunk(
+                    plot_name,
+                    f"{ensemble.name} / {bname} {statistic}",
+                    "",
+                    -1,
+                    result.grid[valid],
+                    getattr(branch, statistic)[valid],
+                )
+
+
+def iterate_experiment_chunks(
+    experiments: Dict[str, CVExperiment], settings: PlotSettings
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield, one cycle at a time, the data of every cycle of every loaded experiment.
+    """
+    for name, experiment in experiments.items():
+        for cid, cycle in enumerate(experiment.cycles):
+            voltage, current = apply_plot_settings(
+                cycle["Vf"], cycle["Im"], experiment, settings
+            )
+            yield build_chunk(
+                name, f"{name} / Cycle {cid}", name, cid, voltage, current
+            )
+
+
+def get_plot_labels(
+    plot_name: str, traces: List[Trace], ensembles: List[EnsembleTrace]
+) -> List[str]:
+    """
+    Return every label written by `iterate_plot_chunks` in the string columns.
+    """
+    labels = [plot_name]
+    for trace in traces:
+        labels += [trace.name, trace.original_experiment]
+    for ensemble in ensembles:
+        labels += [
+            f"{ensemble.name} / {bname} {statistic}"
+            for bname in ENSEMBLE_BRANCHES
+            for statistic in ENSEMBLE_STATISTICS
+        ]
+    return labels
+
+
+def get_experiment_labels(experiments: Dict[str, CVExperiment]) -> List[str]:
+    """
+    Return every label written by `iterate_experiment_chunks` in the string columns.
+    """
+    labels = []
+    for name, experiment in experiments.items():
+        labels.append(name)
+        labels += [f"{name} / Cycle {cid}" for cid, _ in enumerate(experiment.cycles)]
+    return labels
+
+
+def _write_csv(chunks: Iterator[pd.DataFrame], archive: ZipFile, filename: str):
+    with archive.open(f"{filename}.csv", mode="w", force_zip64=True) as entry:
+        text_stream = TextIOWrapper(entry, encoding="utf-8", newline="")
+        for index, chunk in enumerate(chunks):
+            chunk.to_csv(text_stream, header=index == 0, index=False)
+        text_stream.flush()
+        text_stream.detach()
+
+
+def _write_parquet(chunks: Iterator[pd.DataFrame], path: str):
+    with pq.ParquetWriter(path, PARQUET_SCHEMA) as writer:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(
+                chunk, schema=PARQUET_SCHEMA, preserve_index=False
+            )
+            writer.write_table(table)
+
+
+def _write_hdf5(chunks: Iterator[pd.DataFrame], path: str, labels: List[str]):
+    # The width of the HDF5 string columns is fixed by the first appended chunk, so it
+    # is set in advance to fit the longest (UTF-8 encoded) label of the export
+    size = max([len(label.encode("utf-8")) for label in labels], default=1)
+    min_itemsize = {"source": size, "trace": size, "experiment": size}
+    with pd.HDFStore(path, mode="w", complevel=5, complib="zlib") as store:
+        for chunk in chunks:
+            # Empty chunks carry no data and would leave the string columns untyped
+            if chunk.empty:
+                continue
+            store.append(
+                "traces", chunk, format="table", index=False, min_itemsize=min_itemsize
+            )
+
+
+def export_to_zip(
+    chunks: Iterator[pd.DataFrame],
+    labels: List[str],
+    filename: str,
+    format: str,
+    path: str,
+):
+    """
+    Stream the dataframes yielded by `chunks` into the zip archive `path` containing a
+    single long-format table saved in the selected `format` (`csv`, `parquet` or
+    `hdf5`). The `labels` are all the strings written in the `source`, `trace` and
+    `experiment` columns, as given by `get_plot_labels` or `get_experiment_labels`.
+    Only one chunk at a time is kept in memory: the CSV table is written directly into
+    the archive while the Parquet and HDF5 tables are written to a temporary file and
+    then copied in the archive.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format `{format}`")
+
+    with ZipFile(path, mode="w", compression=ZIP_DEFLATED) as archive:
+
+        if format == "csv":
+            _write_csv(chunks, archive, filename)
+
+        else:
+            extension = "parquet" if format == "parquet" else "h5"
+
+            with TemporaryDirectory() as folder:
+                table_path = os.path.join(folder, f"{filename}.{extension}")
+
+                if format == "parquet":
+                    _write_parquet(chunks, table_path)
+                else:
+                    _write_hdf5(chunks, table_path, labels)
+
+                if os.path.isfile(table_path):
+                    with open(table_path, "rb") as source, archive.open(
+                        f"{filename}.{extension}", mode="w", force_zip64=True
+                    ) as entry:
+                        shutil.copyfileobj(source, entry)
@@ -1,5 +1,4 @@
 import plotly
-import numpy as np
 import streamlit as st
 
 def get_plotly_color(index: int) -> str:
@@ -16,12 +15,7 @@ def get_trace_color(experiment_name: str, track_id: int):
             break
 
         else:
-            cycles = [
-                df
-                for df in _experiment.data
-                if type(df["Vf"]) != np.float64
-            ]
-            color_id += len(cycles)
+            color_id += len(_experiment.cycles)
 
     return get_plotly_color(color_id)
 
@@ -34,4 +28,8 @@ def force_update_once():
         st.session_state["forced update executed"] = True
         return
     st.session_state["forced update executed"] = False
-    st.experimental_rerun()
\ No newline at end of file
+    st.experimental_rerun()
+
+def hex_to_rgba(color: str, alpha: float) -> str:
+    red, green, blue = plotly.colors.hex_to_rgb(color)
+    return f"rgba({red}, {green}, {blue}, {alpha})"
@@ -1,10 +1,22 @@
 import logging, traceback, os, sys, pickle
 from io import BytesIO
+from tempfile import TemporaryDirectory
 from typing import List
 from copy import deepcopy
 
 import streamlit as st
 
+from core.data_structures import PlotSettings
+from core.export_tools import (
+    DOWNLOAD_WARNING_SIZE,
+    EXPORT_FORMATS,
+    export_to_zip,
+    get_experiment_labels,
+    get_plot_labels,
+    iterate_experiment_chunks,
+    iterate_plot_chunks,
+)
+
 st.set_page_config(layout="wide")
 
 def generate_session_state_model(keys: List[str]):
@@ -17,7 +29,9 @@ def generate_session_state_model(keys: List[str]):
 
 def save_session_state():
     bytestream = BytesIO()
-    buffer = generate_session_state_model(["experiments", "plot_data", "plot_settings"])
+    buffer = generate_session_state_model(
+        ["experiments", "plot_data", "plot_settings", "ensemble_data"]
+    )
     pickle.dump(buffer, bytestream, protocol=pickle.HIGHEST_PROTOCOL)
     bytestream.seek(0)
     return bytestream
@@ -25,6 +39,12 @@ def save_session_state():
 
 def load_session_state(file: BytesIO):
     loaded_session_state: dict = pickle.load(file)
+
+    # The ensembles refer to the experiments of the previous session. They are reset
+    # before loading so that sessions saved without ensembles do not inherit them.
+    st.session_state["ensemble_data"] = {}
+    st.session_state["ensemble_cache"] = {}
+
     for key, value in loaded_session_state.items():
         st.session_state[key] = value
 
@@ -58,6 +78,92 @@ with texport:
             kwargs={"save": True},
         )
 
+    st.markdown("### Data export:")
+    st.write(
+        """In this section you can export the processed voltage-current data as a single
+    long-format table, compressed in a `.zip` archive. The data are written one trace at
+    a time to a temporary file on disk, but the finished archive is loaded in memory to
+    be served by the download button, so very large exports can use a lot of memory."""
+    )
+
+    experiments = st.session_state.get("experiments", {})
+    plotdata = st.session_state.get("plot_data", {})
+    plotsettings = st.session_state.get("plot_settings", {})
+    ensembledata = st.session_state.get("ensemble_data", {})
+    ensemblecache = st.session_state.get("ensemble_cache", {})
+
+    if experiments == {}:
+        st.info("Please load at least one experiment to export its data")
+
+    else:
+        col1, col2 = st.columns([3, 1])
+
+        with col1:
+            scope = st.radio(
+                "Select the data to export:",
+                ["Traces of a plot", "All cycles of all experiments"],
+                disabled=plotdata == {},
+                index=0 if plotdata != {} else 1,
+            )
+
+            if scope == "Traces of a plot":
+                pname = st.selectbox(
+                    "Select the plot to export:", [name for name in plotdata.keys()]
+                )
+                settings = plotsettings[pname]
+                st.write(
+                    """The normalization and shift options of the plot will be applied.
+                Each ensemble is exported as the mean, sample standard deviation, minimum
+                and maximum of its forward and reverse branches, with `cycle` set to -1."""
+                )
+
+            else:
+                settings = PlotSettings()
+                settings.normalize_by_area = st.checkbox("Apply normalization by area")
+                settings.shift_with_vref = st.checkbox("Apply shift to the potential")
+
+            dataname = st.text_input(
+                "Enter the name of the data file to save", value="my_data"
+            )
+
+        with col2:
+            format = st.selectbox("Select the format of the file", EXPORT_FORMATS)
+            prepare = st.button("⚙️ Prepare data", disabled=dataname == "")
+
+        if prepare:
+            if scope == "Traces of a plot":
+                ensembles = ensembledata.get(pname, [])
+                chunks = iterate_plot_chunks(
+                    pname, plotdata[pname], ensembles, experiments, settings, ensemblecache
+                )
+                labels = get_plot_labels(pname, plotdata[pname], ensembles)
+            else:
+                chunks = iterate_experiment_chunks(experiments, settings)
+                labels = get_experiment_labels(experiments)
+
+            # The download button reads the archive when it is created, so the temporary
+            # folder can be removed as soon as the button has been drawn
+            with TemporaryDirectory() as folder:
+                path = os.path.join(folder, f"{dataname}.zip")
+
+                with st.spinner("Writing the archive to disk..."):
+                    export_to_zip(chunks, labels, dataname, format, path)
+
+                size = os.path.getsize(path)
+                if size > DOWNLOAD_WARNING_SIZE:
+                    st.warning(
+                        f"WARNING: The archive is {size / 1024**2:.0f} MB and it will be "
+                        "kept in memory while it is available for download"
+                    )
+
+                with col2, open(path, "rb") as archive:
+                    st.download_button(
+                        label="📥 Download data",
+                        data=archive,
+                        file_name=f"{dataname}.zip",
+                        mime="application/zip",
+                    )
+
 with timport:
 
     st.markdown("### Session import:")
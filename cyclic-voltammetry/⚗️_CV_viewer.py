@@ -1,5 +1,4 @@
 import streamlit as st
-import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
@@ -8,8 +7,20 @@ from tempfile import NamedTemporaryFile as tmp
 from typing import Dict, List
 
 from core.bytestream_tools import BytesStreamManager
-from core.data_structures import CVExperiment, Trace, PlotSettings
-from core.utils import get_trace_color, force_update_once
+from core.data_structures import (
+    CVExperiment,
+    Trace,
+    PlotSettings,
+    EnsembleTrace,
+    apply_plot_settings,
+)
+from core.ensemble import (
+    EnsembleResult,
+    get_ensemble_result,
+    get_band_coordinates,
+    prune_ensemble_cache,
+)
+from core.utils import get_trace_color, get_plotly_color, hex_to_rgba, force_update_once
 from echemsuite.cyclicvoltammetry.read_input import CyclicVoltammetry
 
 
@@ -22,9 +33,17 @@ if "experiments" not in st.session_state:
     st.session_state["plot_data"] = {}
     st.session_state["plot_settings"] = {}
 
+if "ensemble_data" not in st.session_state:
+    st.session_state["ensemble_data"] = {}
+
+if "ensemble_cache" not in st.session_state:
+    st.session_state["ensemble_cache"] = {}
+
 experiments: Dict[str, CVExperiment] = st.session_state["experiments"]
 plotdata: Dict[str, List[Trace]] = st.session_state["plot_data"]
 plotsettings: Dict[str, PlotSettings] = st.session_state["plot_settings"]
+ensembledata: Dict[str, List[EnsembleTrace]] = st.session_state["ensemble_data"]
+ensemblecache: Dict[tuple, EnsembleResult] = st.session_state["ensemble_cache"]
 
 
 st.title("Cyclic voltammetry viewer")
@@ -118,8 +137,7 @@ if experiments != {}:
                 st.write(experiment.area)
 
             with col5:
-                cycles = [df for df in experiment.data if type(df["Vf"]) != np.float64]
-                st.write(len(cycles))
+                st.write(len(experiment.cycles))
 
     col1, col2 = st.columns([3, 1])
 
@@ -140,12 +158,11 @@ if experiments != {}:
     if apply:
         plotdata[name] = []
         plotsettings[name] = PlotSettings()
+        ensembledata[name] = []
 
         for _name, _experiment in experiments.items():
 
-            cycles = [df for df in _experiment.data if type(df["Vf"]) != np.float64]
-
-            for tid, cycle in enumerate(cycles):
+            for tid, cycle in enumerate(_experiment.cycles):
 
                 voltage = cycle["Vf"]
                 current = cycle["Im"]
@@ -174,6 +191,9 @@ if plotdata != {}:
 
             st.markdown(f"## {pname}")
 
+            if pname not in ensembledata:
+                ensembledata[pname] = []
+
             with st.expander("Trace selector"):
 
                 col1, col2 = st.columns([1, 3])
@@ -181,7 +201,7 @@ if plotdata != {}:
                 with col1:
                     mode = st.radio(
                         "Select operation mode:",
-                        ["Add/remove traces", "Edit single trace"],
+                        ["Add/remove traces", "Edit single trace", "Ensemble average"],
                         key=f"mode_{index}",
                     )
 
@@ -189,6 +209,7 @@ if plotdata != {}:
 
                 if clearall:
                     plotdata[pname] = []
+                    ensembledata[pname] = []
                     st.experimental_rerun()
 
                 with col2:
@@ -204,9 +225,7 @@ if plotdata != {}:
                         )
 
                         experiment = experiments[experiment_name]
-                        cycles = [
-                            df for df in experiment.data if type(df["Vf"]) != np.float64
-                        ]
+                        cycles = experiment.cycles
 
                         last_selection = [
                             trace.original_number
@@ -264,13 +283,17 @@ if plotdata != {}:
                             )
                             trace_index = label_list.index(tname)
 
+                            used_labels = label_list + [
+                                ensemble.name for ensemble in ensembledata[pname]
+                            ]
+
                             label = st.text_input(
                                 "Select the new name of the trace:",
                                 value=tname,
                                 key=f"modify_trace_name_{index}",
                             )
 
-                            if label in label_list and label != tname:
+                            if label in used_labels and label != tname:
                                 st.warning(
                                     f"WARNING: The label `{label}` is already in use"
                                 )
@@ -297,7 +320,7 @@ if plotdata != {}:
                             apply = st.button(
                                 "Apply",
                                 disabled=True
-                                if label == "" or (label in label_list and label != tname)
+                                if label == "" or (label in used_labels and label != tname)
                                 else False,
                                 key=f"modify_apply_{index}",
                             )
@@ -316,6 +339,173 @@ if plotdata != {}:
                                 plotdata[pname][trace_index] = newtrace
                                 st.experimental_rerun()
 
+                    elif mode == "Ensemble average":
+
+                        ensemble_list = [ensemble.name for ensemble in ensembledata[pname]]
+                        used_labels = label_list + ensemble_list
+
+                        ename = st.selectbox(
+                            "Select the ensemble to edit:",
+                            ["➕ New ensemble"] + ensemble_list,
+                            key=f"ensemble_selector_{index}",
+                        )
+
+                        band_options = {
+                            "std": "Mean ± sample standard deviation",
+                            "minmax": "Min/max envelope",
+                        }
+
+                        if ename == "➕ New ensemble":
+
+                            member_map = {
+                                f"{_name} / Cycle {cid}": (_name, cid)
+                                for _name, _experiment in experiments.items()
+                                for cid, _ in enumerate(_experiment.cycles)
+                            }
+
+                            selection = st.multiselect(
+                                "Select the cycles to average:",
+                                [label for label in member_map.keys()],
+                                key=f"ensemble_members_{index}",
+                            )
+
+                            label = st.text_input(
+                                "Select the name of the ensemble:",
+                                value=f"Ensemble {len(ensemble_list)}",
+                                key=f"ensemble_name_{index}",
+                            )
+
+                            if label in used_labels:
+                                st.warning(
+                                    f"WARNING: The label `{label}` is already in use"
+                                )
+
+                            npoints = int(
+                                st.number_input(
+                                    "Select the number of points of the potential grid:",
+                                    min_value=10,
+                                    value=500,
+                                    step=1,
+                                    key=f"ensemble_npoints_{index}",
+                                )
+                            )
+
+                            band = st.selectbox(
+                                "Select the band to show:",
+                                [key for key in band_options.keys()],
+                                format_func=lambda key: band_options[key],
+                                key=f"ensemble_band_{index}",
+                            )
+
+                            color = st.color_picker(
+                                "Select the color of the ensemble:",
+                                value=get_plotly_color(len(used_labels)),
+                                key=f"ensemble_color_{index}",
+                            )
+
+                            add = st.button(
+                                "Add",
+                                disabled=True
+                                if label == "" or label in used_labels or selection == []
+                                else False,
+                                key=f"ensemble_add_{index}",
+                            )
+
+                            if add:
+                                newensemble = EnsembleTrace(
+                                    label,
+                                    [member_map[member] for member in selection],
+                                    color,
+                                    "solid",
+                                    band,
+                                    npoints,
+                                )
+                                ensembledata[pname].append(newensemble)
+                                st.experimental_rerun()
+
+                        else:
+                            ensemble_index = ensemble_list.index(ename)
+                            old = ensembledata[pname][ensemble_index]
+
+                            st.write(
+                                "Averaged cycles: "
+                                + ", ".join(
+                                    f"`{_name} / Cycle {cid}`" for _name, cid in old.members
+                                )
+                            )
+
+                            label = st.text_input(
+                                "Select the new name of the ensemble:",
+                                value=ename,
+                                key=f"modify_ensemble_name_{index}",
+                            )
+
+                            if label in used_labels and label != ename:
+                                st.warning(
+                                    f"WARNING: The label `{label}` is already in use"
+                                )
+
+                            linestyle = st.selectbox(
+                                "Select the line style:",
+                                [
+                                    "solid",
+                                    "dot",
+                                    "dash",
+                                    "longdash",
+                                    "dashdot",
+                                    "longdashdot",
+                                ],
+                                key=f"modify_ensemble_linestyle_{index}",
+                            )
+
+                            band = st.selectbox(
+                                "Select the band to show:",
+                                [key for key in band_options.keys()],
+                                index=[key for key in band_options.keys()].index(old.band),
+                                format_func=lambda key: band_options[key],
+                                key=f"modify_ensemble_band_{index}",
+                            )
+
+                            color = st.color_picker(
+                                "Select the color of the ensemble:",
+                                value=old.color,
+                                key=f"modify_ensemble_color_{index}",
+                            )
+
+                            col3, col4 = st.columns(2)
+
+                            with col3:
+                                apply = st.button(
+                                    "Apply",
+                                    disabled=True
+                                    if label == ""
+                                    or (label in used_labels and label != ename)
+                                    else False,
+                                    key=f"modify_ensemble_apply_{index}",
+                                )
+
+                            with col4:
+                                remove = st.button(
+                                    "🗑️ Remove ensemble",
+                                    key=f"remove_ensemble_{index}",
+                                )
+
+                            if apply:
+                                newensemble = EnsembleTrace(
+                                    label,
+                                    old.members,
+                                    color,
+                                    linestyle,
+                                    band,
+                                    old.npoints,
+                                )
+                                ensembledata[pname][ensemble_index] = newensemble
+                                st.experimental_rerun()
+
+                            if remove:
+                                del ensembledata[pname][ensemble_index]
+                                st.experimental_rerun()
+
             settings = plotsettings[pname]
 
             col1, col2 = st.columns([3, 1])
@@ -400,16 +590,11 @@ if plotdata != {}:
 
                 for trace in plotdata[pname]:
 
-                    voltage, current = trace.voltage, trace.current
-
-                    vref = experiments[trace.original_experiment].vref
-                    area = experiments[trace.original_experiment].area
-
-                    x = [V + vref for V in voltage] if settings.shift_with_vref else voltage
-                    y = (
-                        [I / area for I in current]
-                        if settings.normalize_by_area
-                        else current
+                    x, y = apply_plot_settings(
+                        trace.voltage,
+                        trace.current,
+                        experiments[trace.original_experiment],
+                        settings,
                     )
 
                     fig.add_trace(
@@ -424,6 +609,41 @@ if plotdata != {}:
                         col=1,
                     )
 
+                for ensemble in ensembledata[pname]:
+
+                    result = get_ensemble_result(
+                        ensemble, experiments, settings, ensemblecache
+                    )
+                    x, y, band_x, band_y = get_band_coordinates(result, ensemble.band)
+
+                    fig.add_trace(
+                        go.Scatter(
+                            x=band_x,
+                            y=band_y,
+                            fill="toself",
+                            fillcolor=hex_to_rgba(ensemble.color, 0.25),
+                            line=dict(width=0),
+                            hoverinfo="skip",
+                            legendgroup=ensemble.name,
+                            showlegend=False,
+                        ),
+                        row=1,
+                        col=1,
+                    )
+
+                    fig.add_trace(
+                        go.Scatter(
+                            x=x,
+                            y=y,
+                            name=ensemble.name,
+                            line=dict(color=ensemble.color, dash=ensemble.linestyle),
+                            mode="lines+markers" if settings.show_markers else "lines",
+                            legendgroup=ensemble.name,
+                        ),
+                        row=1,
+                        col=1,
+                    )
+
                 fig.update_xaxes(
                     showline=True,
                     linecolor="black",
@@ -490,4 +710,6 @@ if plotdata != {}:
                     key=f"download_button_{index}",
                 )
 
+    prune_ensemble_cache(ensemblecache, ensembledata, experiments, plotsettings)
+
 force_update_once()